@@ -1,11 +1,45 @@
 import azure.functions as func
 import logging
+import orjson
 import os
 import traceback
 from sharepoint_graph import SharePointGraphClient
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+# Configuration read once at import; app settings don't change within a
+# worker's lifetime
+SHAREPOINT_TENANT_ID = os.environ.get("SHAREPOINT_TENANT_ID")
+SHAREPOINT_SITE_NAME = os.environ.get("SHAREPOINT_SITE_NAME")
+SHAREPOINT_DOCUMENT_LIBRARY = os.environ.get("SHAREPOINT_DOCUMENT_LIBRARY", "Documents")
+
+def _build_client() -> SharePointGraphClient:
+    """
+    Create and pre-warm the shared SharePoint client at worker startup.
+
+    Returns None if the required configuration is missing or warm-up fails;
+    the HTTP trigger falls back to constructing a client per request.
+    """
+    if not SHAREPOINT_TENANT_ID or not SHAREPOINT_SITE_NAME:
+        logging.warning("SharePoint configuration incomplete, skipping client pre-warm")
+        return None
+
+    try:
+        client = SharePointGraphClient(
+            sp_tenant_id=SHAREPOINT_TENANT_ID,
+            site_name=SHAREPOINT_SITE_NAME,
+            document_library=SHAREPOINT_DOCUMENT_LIBRARY
+        )
+        client.warm_up()
+        return client
+    except Exception as e:
+        logging.warning(f"Failed to pre-warm SharePoint client: {str(e)}")
+        return None
+
+# Shared client, created once per worker so warm invocations skip token
+# acquisition and reuse the client's connection pool
+sharepoint_client = _build_client()
+
 @app.route(route="httpget", methods=["GET"])
 def http_get(req: func.HttpRequest) -> func.HttpResponse:
     name = req.params.get("name", "World")
@@ -23,38 +57,34 @@ def sharepoint_docs_list(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("SharePoint documents listing function triggered")
     
     try:
-        # Check environment variable configuration
-        sp_tenant_id = os.environ.get("SHAREPOINT_TENANT_ID")
-        site_name = os.environ.get("SHAREPOINT_SITE_NAME")
-        document_library = os.environ.get("SHAREPOINT_DOCUMENT_LIBRARY", "Documents")
-        
         # Check for required configuration
-        if not sp_tenant_id:
+        if not SHAREPOINT_TENANT_ID:
             return func.HttpResponse(
                 "SHAREPOINT_TENANT_ID environment variable must be set",
                 status_code=400
             )
-            
-        if not site_name:
+
+        if not SHAREPOINT_SITE_NAME:
             return func.HttpResponse(
                 "SHAREPOINT_SITE_NAME environment variable must be set",
                 status_code=400
             )
-        
-        # Initialize client
-        client = SharePointGraphClient(
-            sp_tenant_id=sp_tenant_id,
-            site_name=site_name,
-            document_library=document_library
-        )
-        
-        # Get all documents
-        docs = client.list_documents()
-        
-        # Return the documents as JSON
-        import json
+
+        # Reuse the pre-warmed client when available
+        client = sharepoint_client
+        if client is None:
+            client = SharePointGraphClient(
+                sp_tenant_id=SHAREPOINT_TENANT_ID,
+                site_name=SHAREPOINT_SITE_NAME,
+                document_library=SHAREPOINT_DOCUMENT_LIBRARY
+            )
+
+        # Serialize documents into the JSON body as they are discovered
+        # instead of materializing the full list first
+        body = b'{"documents":[' + b",".join(map(orjson.dumps, client.iter_documents())) + b"]}"
+
         return func.HttpResponse(
-            json.dumps({"documents": docs}),
+            body,
             mimetype="application/json"
         )
         
@@ -7,14 +7,26 @@ import os
 import time
 import json
 import logging
+import threading
 import traceback
+import orjson
 import requests
-from typing import List, Dict, Any, Optional
-from azure.identity import DefaultAzureCredential
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from urllib.parse import quote, urlencode
+from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 
 # Configure logging
 logger = logging.getLogger('sharepoint-graph')
 
+# Module-level token cache shared by every client instance in the worker
+# process, so a newly constructed client doesn't re-acquire a token another
+# client already holds
+_token_cache = {"token": None, "expires_at": 0}
+_token_cache_lock = threading.Lock()
+
 class SharePointGraphClient:
     """Client for accessing SharePoint documents via Microsoft Graph API"""
 
@@ -24,6 +36,16 @@ class SharePointGraphClient:
     # Required scopes for accessing SharePoint documents
     GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
 
+    # Maximum number of sub-requests allowed in a single $batch call
+    BATCH_MAX_REQUESTS = 20
+
+    # Maximum attempts per $batch sub-request before the traversal fails;
+    # Graph throttles sub-requests individually, below the adapter's retry
+    SUB_REQUEST_MAX_ATTEMPTS = 3
+
+    # Maximum number of worker threads for concurrent folder enumeration
+    MAX_WORKERS = 16
+
     def __init__(
         self,
         sp_tenant_id: str = None,
@@ -48,22 +70,64 @@ class SharePointGraphClient:
         
         self.document_library = document_library or os.environ.get("SHAREPOINT_DOCUMENT_LIBRARY", "Documents")
         
-        # Initialize credential
-        self.credential = DefaultAzureCredential()
+        # Initialize credential. Prefer the app's managed identity when
+        # running in Azure: it goes straight to the identity endpoint instead
+        # of probing the credential chain DefaultAzureCredential walks.
+        # DefaultAzureCredential remains the fallback for local development.
+        if os.environ.get("IDENTITY_ENDPOINT") or os.environ.get("MSI_ENDPOINT"):
+            self.credential = ManagedIdentityCredential()
+        else:
+            self.credential = DefaultAzureCredential()
         self.token = None
         self.token_expires_at = 0
 
+        # Cached site and drive IDs; these are stable for a given site and
+        # library, so they only need to be resolved once per client
+        self._site_id = None
+        self._drive_id = None
+
+        # Shared HTTP session: keeps connections to graph.microsoft.com alive
+        # across requests and lets concurrent workers draw from one pool.
+        # Retries (including 429 throttling, honoring Retry-After) happen in
+        # urllib3 at the connection layer rather than in Python loop code.
+        retry = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"]
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=64, max_retries=retry))
+        self._session.headers["Content-Type"] = "application/json"
+
     def _ensure_token(self) -> None:
         """Ensure we have a valid access token"""
-        current_time = time.time()
-        
-        # If token is expired or will expire in next 5 minutes, refresh it
-        if self.token is None or current_time >= (self.token_expires_at - 300):
-            logger.info("Getting new access token")
-            token = self.credential.get_token(*self.GRAPH_SCOPES)
-            self.token = token.token
-            self.token_expires_at = token.expires_on
-            logger.info(f"Token acquired, expires at: {self.token_expires_at}")
+        # Serialize token acquisition so concurrent workers don't race on refresh
+        with _token_cache_lock:
+            current_time = time.time()
+
+            # If token is expired or will expire in next 5 minutes, refresh it
+            if _token_cache["token"] is None or current_time >= (_token_cache["expires_at"] - 300):
+                logger.info("Getting new access token")
+                token = self.credential.get_token(*self.GRAPH_SCOPES)
+                _token_cache["token"] = token.token
+                _token_cache["expires_at"] = token.expires_on
+                logger.info(f"Token acquired, expires at: {_token_cache['expires_at']}")
+
+            # Sync this client (and its session auth header) with the cache
+            if self.token != _token_cache["token"]:
+                self.token = _token_cache["token"]
+                self.token_expires_at = _token_cache["expires_at"]
+                self._session.headers["Authorization"] = f"Bearer {self.token}"
+
+    def warm_up(self) -> None:
+        """
+        Acquire an access token ahead of the first request.
+
+        Intended to be called at worker startup so the first invocation
+        doesn't pay the token acquisition cost.
+        """
+        self._ensure_token()
 
     def _make_request(
         self, 
@@ -87,49 +151,48 @@ class SharePointGraphClient:
             Response object
         """
         self._ensure_token()
-        
-        url = f"{self.GRAPH_API_ENDPOINT}{endpoint}"
-        
-        if headers is None:
-            headers = {}
-            
-        headers.update({
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        })
-        
-        # Implement retry logic with exponential backoff
-        max_retries = 3
-        retry_delay = 1  # Start with 1 second delay
-        
-        for attempt in range(max_retries):
-            try:
-                #logger.info(f"Making {method} request to {url} with params: {params} and headers: {headers}")
-                logger.info(f"Making {method} request to {url} with params: {params}")
-                response = requests.request(
-                    method=method,
-                    url=url,
-                    params=params,
-                    headers=headers,
-                    json=json_data,
-                    timeout=30  # Set a reasonable timeout
-                )
-                
-                # Check if request was successful
-                response.raise_for_status()
-                return response
-                
-            except (requests.RequestException, ConnectionError) as e:
-                if attempt < max_retries - 1:
-                    logger.warning(f"Request failed (attempt {attempt+1}/{max_retries}): {str(e)}. Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                else:
-                    logger.error(f"Request failed after {max_retries} attempts: {str(e)}")
-                    raise
-        
-        # This shouldn't be reached due to the raise in the exception handler, but added for completeness
-        return None
+
+        url = self.GRAPH_API_ENDPOINT + endpoint
+
+        # Authorization and Content-Type live on the session headers;
+        # retries with exponential backoff happen in the session's adapter
+        try:
+            logger.info(f"Making {method} request to {url} with params: {params}")
+            response = self._session.request(
+                method=method,
+                url=url,
+                params=params,
+                headers=headers,
+                json=json_data,
+                timeout=30  # Set a reasonable timeout
+            )
+
+            # Check if request was successful
+            response.raise_for_status()
+            return response
+
+        except (requests.RequestException, ConnectionError) as e:
+            logger.error(f"Request failed after retries: {str(e)}")
+            raise
+
+    def _batch_request(self, requests_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send multiple Graph requests in a single JSON $batch call.
+
+        Args:
+            requests_list: List of batch sub-requests, each with "id", "method" and "url" keys
+                           (at most BATCH_MAX_REQUESTS entries per the Graph API spec)
+
+        Returns:
+            List of batch sub-responses, each with "id", "status" and "body" keys
+        """
+        if len(requests_list) > self.BATCH_MAX_REQUESTS:
+            raise ValueError(f"Batch requests are limited to {self.BATCH_MAX_REQUESTS} sub-requests, got {len(requests_list)}")
+
+        response = self._make_request("POST", "/$batch", json_data={"requests": requests_list})
+        # orjson is noticeably faster than the stdlib parser on the large
+        # multi-folder payloads batch calls return
+        return orjson.loads(response.content).get("responses", [])
 
     def get_site_id(self) -> str:
         """
@@ -141,6 +204,9 @@ class SharePointGraphClient:
         Raises:
             ValueError: If site ID cannot be retrieved, with details about the response
         """
+        if self._site_id:
+            return self._site_id
+
         logger.info(f"Getting site ID for: {self.site_name}")
         
         # Format the request for site lookup
@@ -157,6 +223,7 @@ class SharePointGraphClient:
             raise ValueError(f"Could not retrieve site ID for {self.site_name}. Error: {error_msg}. Response: {site_data}")
             
         logger.info(f"Retrieved site ID: {site_id}")
+        self._site_id = site_id
         return site_id
 
     def get_drive_id(self, site_id: str) -> str:
@@ -172,11 +239,65 @@ class SharePointGraphClient:
         Raises:
             ValueError: If drive ID cannot be retrieved, with details about available drives
         """
+        if self._drive_id:
+            return self._drive_id
+
+        try:
+            return self._resolve_drive_id(site_id)
+        except requests.HTTPError as e:
+            # A 404 here usually means the cached site ID went stale (the
+            # site was deleted and recreated); since the client lives for
+            # the whole worker, invalidate the cache and retry once with a
+            # freshly resolved site ID
+            if e.response is not None and e.response.status_code == 404:
+                logger.warning(f"Drive lookup returned 404 for site {site_id}; re-resolving site ID and retrying")
+                self._site_id = None
+                return self._resolve_drive_id(self.get_site_id())
+            raise
+
+    def _resolve_drive_id(self, site_id: str) -> str:
+        """
+        Resolve the drive ID for the document library from Graph.
+
+        Args:
+            site_id: The SharePoint site ID
+
+        Returns:
+            The drive ID for the document library
+
+        Raises:
+            ValueError: If no drive matches the document library
+            requests.HTTPError: If the drive listing request fails
+        """
         logger.info(f"Getting drive ID for document library: {self.document_library}")
-        
-        # First try to get the drive by name
+
         endpoint = f"/sites/{site_id}/drives"
-        
+
+        # Ask the server for the matching drive directly so sites with many
+        # libraries don't ship the whole drive list over the wire
+        params = {
+            "$filter": f"name eq '{self.document_library}'",
+            "$select": "id,name"
+        }
+
+        try:
+            response = self._make_request("GET", endpoint, params=params)
+            filtered_drives = response.json().get("value", [])
+        except requests.RequestException:
+            # Not every tenant supports $filter on drives; fall back to the
+            # full listing below
+            logger.warning("Filtered drive query failed, falling back to full drive listing")
+            filtered_drives = []
+
+        for drive in filtered_drives:
+            if drive.get("name") == self.document_library:
+                drive_id = drive.get("id")
+                logger.info(f"Found drive ID for {self.document_library}: {drive_id}")
+                self._drive_id = drive_id
+                return drive_id
+
+        # Fall back to listing every drive and scanning by name; this also
+        # yields the list of available drives for the error message
         response = self._make_request("GET", endpoint)
         response_data = response.json()
         drives = response_data.get("value", [])
@@ -189,6 +310,7 @@ class SharePointGraphClient:
             if drive.get("name") == self.document_library:
                 drive_id = drive.get("id")
                 logger.info(f"Found drive ID for {self.document_library}: {drive_id}")
+                self._drive_id = drive_id
                 return drive_id
                         
         # If we get here, no suitable drive was found
@@ -196,117 +318,293 @@ class SharePointGraphClient:
         available_drives_str = ", ".join(available_drives) if available_drives else "No drives found"
         raise ValueError(f"Could not find drive for document library: {self.document_library}. Available drives: {available_drives_str}")
 
+    @staticmethod
+    def _children_url(drive_root: str, children_suffix: str, folder_path: str = "") -> str:
+        """
+        Build the URL that lists the children of a drive folder.
+
+        Args:
+            drive_root: Pre-built "/sites/{id}/drives/{id}/root" prefix
+            children_suffix: Pre-built "/children?{query}" suffix
+            folder_path: Optional path to a subfolder
+
+        Returns:
+            The request URL (relative to the Graph API root)
+        """
+        if folder_path:
+            # Batch sub-request URLs travel inside the JSON body, so nothing
+            # downstream re-encodes them; quote the path (keeping the "/"
+            # separators) so names with spaces, "%" or "#" stay valid
+            return "".join((drive_root, ":/", quote(folder_path), ":", children_suffix))
+        return drive_root + children_suffix
+
+    def _relative_url(self, url: str) -> str:
+        """
+        Strip the Graph API root from an absolute URL.
+
+        @odata.nextLink values come back absolute; batch sub-request URLs
+        must be relative to the API root.
+
+        Args:
+            url: Absolute or already-relative Graph URL
+
+        Returns:
+            The URL relative to the Graph API root
+        """
+        if url.startswith(self.GRAPH_API_ENDPOINT):
+            return url[len(self.GRAPH_API_ENDPOINT):]
+        return url
+
     def list_documents_in_drive(self, site_id: str, drive_id: str, folder_path: str = "") -> List[Dict[str, Any]]:
         """
-        List documents in the specified folder.
-        
+        List documents in the specified folder and all of its subfolders.
+
+        Folders are traversed breadth-first, with up to BATCH_MAX_REQUESTS
+        child listings combined into a single Graph $batch call per round trip.
+
         Args:
             site_id: The SharePoint site ID
             drive_id: The drive ID
             folder_path: Optional path to a subfolder
-            
+
         Returns:
             List of document metadata
-            
+
         Raises:
             ValueError: If folder path is invalid or permissions issue
             requests.RequestException: If API request fails with detailed error information
         """
-        logger.info(f"Listing documents in folder: '{folder_path or 'root'}'")
-        
-        # Format the endpoint
-        endpoint = f"/sites/{site_id}/drives/{drive_id}/root"
-        if folder_path:
-            endpoint = f"{endpoint}:/{folder_path}:"
-        endpoint = f"{endpoint}/children"
-        
+        return list(self.iter_documents_in_drive(site_id, drive_id, folder_path))
+
+    def iter_documents_in_drive(self, site_id: str, drive_id: str, folder_path: str = "") -> Iterator[Dict[str, Any]]:
+        """
+        Iterate documents in the specified folder and all of its subfolders.
+
+        Yields documents batch-by-batch as Graph responses complete, so
+        callers can serialize or forward results without holding the full
+        list in memory.
+
+        Args:
+            site_id: The SharePoint site ID
+            drive_id: The drive ID
+            folder_path: Optional path to a subfolder
+
+        Yields:
+            Document metadata dicts
+
+        Raises:
+            ValueError: If folder path is invalid or permissions issue
+            requests.RequestException: If API request fails with detailed error information
+        """
+        # Only request the fields the listing actually uses; expanding
+        # thumbnails inflates both payload size and server-side work
         params = {
             "$select": "id,name,size,webUrl,file,folder",
-            "$expand": "thumbnails",
             "$top": 1000  # Adjust as needed
         }
-        
+        query_string = urlencode(params)
+
+        # Pre-build the constant URL parts once; each per-folder URL is then
+        # a single join instead of re-formatting the site/drive segments
+        drive_root = f"/sites/{site_id}/drives/{drive_id}/root"
+        children_suffix = f"/children?{query_string}"
+
+        # Acquire the token once up-front so worker threads don't all hit the
+        # credential endpoint at the same time on first use
+        self._ensure_token()
+
+        # Work queue of (folder path, request URL, attempt count) entries;
+        # subfolder listings, @odata.nextLink continuations and throttled
+        # sub-request retries all flow through it
+        pending_requests = [
+            (folder_path, self._children_url(drive_root, children_suffix, folder_path), 0)
+        ]
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            in_flight = set()
+
+            while pending_requests or in_flight:
+                # Submit one batch per chunk of pending requests
+                while pending_requests:
+                    current_requests = pending_requests[:self.BATCH_MAX_REQUESTS]
+                    pending_requests = pending_requests[self.BATCH_MAX_REQUESTS:]
+                    in_flight.add(executor.submit(
+                        self._list_folders_batch, drive_root, children_suffix, current_requests
+                    ))
+
+                # Wait for at least one batch to finish, then fold in its results
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_documents, batch_next_requests = future.result()
+                    pending_requests.extend(batch_next_requests)
+                    yield from batch_documents
+
+    def _list_folders_batch(
+        self,
+        drive_root: str,
+        children_suffix: str,
+        current_requests: List[Tuple[str, str, int]]
+    ) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str, int]]]:
+        """
+        List the children of up to BATCH_MAX_REQUESTS folders in one $batch call.
+
+        Args:
+            drive_root: Pre-built "/sites/{id}/drives/{id}/root" URL prefix
+            children_suffix: Pre-built "/children?{query}" URL suffix
+            current_requests: (folder path, request URL, attempt count)
+                              entries to issue (at most BATCH_MAX_REQUESTS)
+
+        Returns:
+            Tuple of (documents found, follow-up (folder path, request URL,
+            attempt count) entries for discovered subfolders, continuation
+            pages and throttled retries)
+        """
+        logger.info(f"Listing documents in {len(current_requests)} folder(s) starting at: '{current_requests[0][0] or 'root'}'")
+
+        requests_list = [
+            {
+                "id": str(index),
+                "method": "GET",
+                "url": url
+            }
+            for index, (_, url, _) in enumerate(current_requests)
+        ]
+
         try:
-            response = self._make_request("GET", endpoint, params=params)
-            response_data = response.json()
-            
-            # Check if there's an error in the response
-            if "error" in response_data:
-                error = response_data["error"]
-                error_message = error.get("message", "Unknown error")
-                logger.error(f"Error listing documents: {error_message}")
-                raise ValueError(f"Failed to list documents: {error_message}")
-            
-            items = response_data.get("value", [])
-            logger.info(f"Found {len(items)} items in folder '{folder_path or 'root'}'")
+            responses = self._batch_request(requests_list)
         except requests.RequestException as e:
-            logger.error(f"Failed to list documents in folder '{folder_path}': {str(e)}", exc_info=True)
+            logger.error(f"Failed to list documents in folders {[path for path, _, _ in current_requests]}: {str(e)}", exc_info=True)
             raise
-        
+
         documents = []
-        folders = []
-        
-        # Process the returned items
-        for item in items:
-            if "folder" in item:
-                folder_name = item.get("name", "")
-                folder_path_new = f"{folder_path}/{folder_name}" if folder_path else folder_name
-                folders.append({"name": folder_name, "path": folder_path_new})
-            elif "file" in item:
-                documents.append({
-                    "id": item.get("id", ""),
-                    "name": item.get("name", ""),
-                    "path": folder_path,
-                    "size": item.get("size", 0),
-                    "web_url": item.get("webUrl", "")
-                })
-                
-        # Recursively get documents from subfolders
-        for folder in folders:
-            subfolder_docs = self.list_documents(site_id, drive_id, folder["path"])
-            documents.extend(subfolder_docs)
-            
-        return documents
+        next_requests = []
+        retry_delay = 0
 
-    def log_document(self, document: Dict[str, Any]) -> None:
+        for sub_response in responses:
+            response_folder, response_url, response_attempts = current_requests[int(sub_response.get("id", 0))]
+            status = sub_response.get("status", 200)
+            body = sub_response.get("body", {})
+
+            # Graph throttles $batch sub-requests individually: a 200 batch
+            # envelope can carry per-sub-request 429/5xx bodies the session
+            # adapter's retry never sees. Re-enqueue those with a bounded
+            # attempt count instead of failing the whole traversal.
+            if status == 429 or status >= 500:
+                attempts = response_attempts + 1
+                if attempts >= self.SUB_REQUEST_MAX_ATTEMPTS:
+                    logger.error(f"Sub-request for folder '{response_folder or 'root'}' failed with status {status} after {attempts} attempts")
+                    raise ValueError(f"Failed to list documents in folder '{response_folder or 'root'}': throttled or unavailable (status {status}) after {attempts} attempts")
+
+                headers = sub_response.get("headers") or {}
+                retry_after = headers.get("Retry-After") or headers.get("retry-after")
+                try:
+                    retry_delay = max(retry_delay, int(retry_after))
+                except (TypeError, ValueError):
+                    retry_delay = max(retry_delay, 1)
+
+                logger.warning(f"Sub-request for folder '{response_folder or 'root'}' returned status {status}, retrying (attempt {attempts}/{self.SUB_REQUEST_MAX_ATTEMPTS})")
+                next_requests.append((response_folder, response_url, attempts))
+                continue
+
+            # Check if there's an error in the sub-response
+            if status >= 400 or "error" in body:
+                error = body.get("error", {})
+                error_message = error.get("message", "Unknown error")
+                logger.error(f"Error listing documents in folder '{response_folder or 'root'}': {error_message}")
+                raise ValueError(f"Failed to list documents: {error_message}")
+
+            items = body.get("value", [])
+            logger.info(f"Found {len(items)} items in folder '{response_folder or 'root'}'")
+
+            # Process the returned items
+            for item in items:
+                if "folder" in item:
+                    folder_name = item.get("name", "")
+                    folder_path_new = f"{response_folder}/{folder_name}" if response_folder else folder_name
+                    next_requests.append(
+                        (folder_path_new, self._children_url(drive_root, children_suffix, folder_path_new), 0)
+                    )
+                elif "file" in item:
+                    # Reshape the Graph item in place instead of building a
+                    # fresh dict per document
+                    item.pop("file", None)
+                    item["path"] = response_folder
+                    item["web_url"] = item.pop("webUrl", "")
+                    item.setdefault("id", "")
+                    item.setdefault("name", "")
+                    item.setdefault("size", 0)
+                    documents.append(item)
+
+            # Folders with more than one page of children return a
+            # continuation link; enqueue it like any other pending request
+            next_link = body.get("@odata.nextLink")
+            if next_link:
+                next_requests.append((response_folder, self._relative_url(next_link), 0))
+
+        # Honor the longest Retry-After among throttled sub-requests before
+        # this worker hands its retries back to the queue
+        if retry_delay:
+            time.sleep(retry_delay)
+
+        return documents, next_requests
+
+    def log_documents(self, documents: List[Dict[str, Any]]) -> None:
         """
         Log document information (instead of downloading).
-        
+
+        Emits a single log write for the whole batch rather than one
+        logger call per document.
+
         Args:
-            document: Document metadata
+            documents: List of document metadata
         """
-        doc_id = document.get("id")
-        doc_name = document.get("name")
-        doc_path = document.get("path", "")
-        doc_size = document.get("size", 0)
-        doc_url = document.get("web_url", "")
-        
-        # Validate document metadata
-        if not doc_id or not doc_name:
-            missing_fields = []
-            if not doc_id: 
-                missing_fields.append("id")
-            if not doc_name: 
-                missing_fields.append("name")
-            logger.warning(f"Incomplete document metadata. Missing fields: {', '.join(missing_fields)}. Document data: {document}")
-            return
-        
-        full_path = f"{doc_path}/{doc_name}" if doc_path else doc_name
-        logger.info(f"Found document: {full_path} (ID: {doc_id}, Size: {doc_size} bytes, URL: {doc_url})")
+        lines = []
+        incomplete = []
+
+        for document in documents:
+            doc_id = document.get("id")
+            doc_name = document.get("name")
+
+            # Validate document metadata
+            if not doc_id or not doc_name:
+                incomplete.append(document)
+                continue
+
+            doc_path = document.get("path", "")
+            full_path = f"{doc_path}/{doc_name}" if doc_path else doc_name
+            lines.append(f"{full_path} (ID: {doc_id}, Size: {document.get('size', 0)} bytes, URL: {document.get('web_url', '')})")
+
+        if incomplete:
+            logger.warning(f"{len(incomplete)} document(s) with incomplete metadata (missing id or name): {incomplete}")
+
+        logger.info(f"Found {len(lines)} documents:\n" + "\n".join(lines))
 
     def list_documents(self) -> List[Dict[str, Any]]:
         """
         List documents from the document library.
-        
+
         Returns:
             List of document information
         """
         # Get IDs needed for the operations
         site_id = self.get_site_id()
         drive_id = self.get_drive_id(site_id)
-        
+
         # List all documents
         documents = self.list_documents_in_drive(site_id, drive_id)
-                        
+
         logger.info(f"Processed {len(documents)} documents")
         return documents
+
+    def iter_documents(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate documents from the document library as they are discovered.
+
+        Yields:
+            Document information dicts
+        """
+        # Get IDs needed for the operations
+        site_id = self.get_site_id()
+        drive_id = self.get_drive_id(site_id)
+
+        yield from self.iter_documents_in_drive(site_id, drive_id)